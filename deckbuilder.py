@@ -1,11 +1,22 @@
 # deckbuilder.py
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import time
 import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import unicodedata
-from bs4 import BeautifulSoup
+import functools
+from collections import Counter
+import os
+from pathlib import Path
+import orjson
+from rapidfuzz import process
+from rapidfuzz.distance import JaroWinkler
 
 # ----------------------------
 # Config / UI
@@ -28,15 +39,25 @@ sort_after = st.selectbox("🔽 Sortierung nach dem Bauen", ["Keine", "Kartentyp
 # ----------------------------
 # Helpers: Normalisierung & Klassifikation
 # ----------------------------
+_RE_SLUG_STRIP = re.compile(r"[^\w\s-]")
+_RE_SLUG_DASHES = re.compile(r"-{2,}")
+_RE_COUNT = re.compile(r'^\d+\s+')               # leading counts like "2 "
+_RE_SETPAREN = re.compile(r'\s*\(.*?\)\s*$')     # trailing "(set)" blocks
+_RE_QUOTES = re.compile(r'[\u2018\u2019`\'"]')    # fancy quotes
+_RE_PUNCT = re.compile(r'[^a-z0-9\s-]')          # remove punctuation
+_RE_WS = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=2048)
 def _ascii_slug(s: str) -> str:
     s = unicodedata.normalize("NFKD", s or "")
     s = s.encode("ascii", "ignore").decode("ascii")
     s = s.lower()
-    s = re.sub(r"[^\w\s-]", "", s)
-    s = re.sub(r"\s+", "-", s).strip("-")
-    s = re.sub(r"-{2,}", "-", s)
+    s = _RE_SLUG_STRIP.sub("", s)
+    s = _RE_WS.sub("-", s).strip("-")
+    s = _RE_SLUG_DASHES.sub("-", s)
     return s
 
+@functools.lru_cache(maxsize=4096)
 def _norm_name(s: str) -> str:
     """Normalize a card name for matching: lower, remove accents, strip counts and set-parens."""
     if not s:
@@ -45,40 +66,84 @@ def _norm_name(s: str) -> str:
     s = unicodedata.normalize("NFKD", s)
     s = s.encode("ascii", "ignore").decode("ascii")
     s = s.lower().strip()
-    s = re.sub(r'^\d+\s+', '', s)               # leading counts like "2 "
-    s = re.sub(r'\s*\(.*?\)\s*$', '', s)       # trailing "(set)" blocks
-    s = re.sub(r'[\u2018\u2019`\'"]', '', s)    # fancy quotes
-    s = re.sub(r'[^a-z0-9\s-]', ' ', s)        # remove punctuation
-    s = re.sub(r'\s+', ' ', s).strip()
+    s = _RE_COUNT.sub('', s)
+    s = _RE_SETPAREN.sub('', s)
+    s = _RE_QUOTES.sub('', s)
+    s = _RE_PUNCT.sub(' ', s)
+    s = _RE_WS.sub(' ', s).strip()
     return s
 
+def _norm_name_series(s: pd.Series) -> pd.Series:
+    """Vectorized _norm_name for a whole column of names."""
+    s = s.fillna("").astype(str)
+    s = s.str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+    s = s.str.lower().str.strip()
+    s = s.str.replace(_RE_COUNT, "", regex=True)
+    s = s.str.replace(_RE_SETPAREN, "", regex=True)
+    s = s.str.replace(_RE_QUOTES, "", regex=True)
+    s = s.str.replace(_RE_PUNCT, " ", regex=True)
+    return s.str.replace(_RE_WS, " ", regex=True).str.strip()
+
+# One alternation per field; group order == priority of the original if-chain
+# (land, creature > oracle categories > remaining types).
+_TYPE_RE = re.compile(r"(?P<land>land)|(?P<creature>creature)|(?P<enchant>enchant)|(?P<artifact>artifact)|(?P<instant>instant)|(?P<sorcery>sorcery)")
+_ORACLE_RE = re.compile(
+    r"(?P<ramp>add \{m|search your library for a land|ramp)"
+    r"|(?P<draw>draw a card|scry|investigate)"
+    r"|(?P<removal>destroy target|exile target|counter target)"
+    r"|(?P<wincon>you win the game|extra turn|infinite)"
+)
+_FN_LABELS = {
+    "land": "Land", "creature": "Creature",
+    "ramp": "Ramp", "draw": "Card Draw", "removal": "Removal/Interaction", "wincon": "Wincon/Finisher",
+    "enchant": "Enchantment", "artifact": "Artifact", "instant": "Instant", "sorcery": "Sorcery",
+}
+_ORACLE_PRIO = {g: i for i, g in enumerate(_ORACLE_RE.groupindex)}
+_TYPE_PRIO = {g: i for i, g in enumerate(_TYPE_RE.groupindex)}
+
 def detect_function(card: dict) -> str:
     if not card:
         return "Other"
+    fn = card.get("_fn")
+    if fn is not None:
+        return fn
     t = (card.get("type_line") or "").lower()
-    o = (card.get("oracle_text") or "").lower()
-    if "land" in t: return "Land"
-    if "creature" in t: return "Creature"
-    if "add {m" in o or "search your library for a land" in o or "ramp" in o: return "Ramp"
-    if "draw a card" in o or "scry" in o or "investigate" in o: return "Card Draw"
-    if "destroy target" in o or "exile target" in o or "counter target" in o: return "Removal/Interaction"
-    if "you win the game" in o or "extra turn" in o or "infinite" in o: return "Wincon/Finisher"
-    if "enchant" in t: return "Enchantment"
-    if "artifact" in t: return "Artifact"
-    if "instant" in t: return "Instant"
-    if "sorcery" in t: return "Sorcery"
-    return "Other"
-
-def get_price_eur(card: dict) -> float:
-    p = (card or {}).get("prices") or {}
-    eur = p.get("eur")
-    usd = p.get("usd")
-    try:
-        if eur: return float(eur)
-        if usd: return float(usd)
-    except Exception:
-        pass
-    return 0.0
+    types = sorted((m.lastgroup for m in _TYPE_RE.finditer(t)), key=_TYPE_PRIO.get)
+    if types and types[0] in ("land", "creature"):
+        fn = _FN_LABELS[types[0]]
+    else:
+        o = (card.get("oracle_text") or "").lower()
+        best = None
+        for m in _ORACLE_RE.finditer(o):
+            if best is None or _ORACLE_PRIO[m.lastgroup] < _ORACLE_PRIO[best]:
+                best = m.lastgroup
+                if _ORACLE_PRIO[best] == 0:
+                    break
+        group = best or (types[0] if types else None)
+        fn = _FN_LABELS[group] if group else "Other"
+    card["_fn"] = fn
+    return fn
+
+def _is_land(card: dict) -> bool:
+    return "land" in (card.get("type_line") or "").lower()
+
+def _card_id(card: dict) -> str:
+    """Stable identity for membership checks: the oracle id, so two printings of one card
+    (bulk, fuzzy, collection or SQLite lookups can each return a different one) still match."""
+    return card.get("oracle_id") or card.get("id") or card.get("name")
+
+_COLOR_BITS = {"W": 1, "U": 2, "B": 4, "R": 8, "G": 16}
+
+def _cid_mask(card: dict) -> int:
+    """Color identity as a WUBRG bitmask, cached on the card dict."""
+    m = card.get("_cid_mask")
+    if m is None:
+        m = card["_cid_mask"] = sum(_COLOR_BITS.get(x, 0) for x in (card.get("color_identity") or []))
+    return m
+
+def is_commander_legal(card: dict, commander_mask: int) -> bool:
+    """Color identity of `card` within the commander's (mask from _cid_mask)."""
+    return (_cid_mask(card) & ~commander_mask) == 0
 
 # ----------------------------
 # Staples (häufig gewünschte Auto-Adds)
@@ -89,76 +154,535 @@ STAPLES = [
     "cultivate", "farseek", "explosive vegetation", "sol ring"  # duplicates ok, normalized later
 ]
 
+# ----------------------------
+# HTTP session (keep-alive + retries)
+# ----------------------------
+# Streamlit re-executes this script on every interaction; cache_resource keeps one
+# session (and its connection pool) per process instead of one per rerun.
+@st.cache_resource(show_spinner=False)
+def get_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({"User-Agent": "MTG-Deckbuilder/1.0", "Accept": "application/json"})
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4, pool_maxsize=16,
+        # POST /cards/collection is a read-only lookup, so it is safe to retry like GET
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=frozenset({"GET", "POST"})),
+    ))
+    return session
+
+_SESSION = get_session()
+
+# ----------------------------
+# Rate limiting for concurrent Scryfall lookups
+# ----------------------------
+SCRYFALL_WORKERS = 10
+
+class _RateLimiter:
+    """Token bucket: at most `rate` acquisitions per second, bursts up to `rate`."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 0.0
+            self.ts = time.monotonic()
+
+@st.cache_resource(show_spinner=False)
+def _get_scryfall_limiter() -> _RateLimiter:
+    return _RateLimiter(10)  # Scryfall guideline: ~10 requests/s
+
+_SCRYFALL_RL = _get_scryfall_limiter()  # shared across reruns and sessions
+
+# ----------------------------
+# Disk cache for Scryfall/EDHREC lookups (L2 under st.cache_data)
+# ----------------------------
+CARD_CACHE_TTL = 30 * 24 * 3600  # seconds
+EDHREC_CACHE_TTL = 24 * 3600  # seconds
+
+@st.cache_resource(show_spinner=False)
+def _get_card_db():
+    db = sqlite3.connect("scryfall_cache.sqlite", check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS cards (norm_name TEXT PRIMARY KEY, json BLOB, fetched_at INTEGER)")
+    db.execute("CREATE TABLE IF NOT EXISTS edhrec (slug TEXT PRIMARY KEY, json BLOB, fetched_at INTEGER)")
+    return db, threading.Lock()
+
+_card_db, _card_db_lock = _get_card_db()
+
+def _db_get_card(key: str):
+    with _card_db_lock:
+        row = _card_db.execute("SELECT json, fetched_at FROM cards WHERE norm_name=?", (key,)).fetchone()
+    if row and time.time() - row[1] < CARD_CACHE_TTL:
+        return orjson.loads(row[0])
+    return None
+
+def _db_put_cards(items):
+    """Store (norm_name, card) pairs in one transaction."""
+    now = int(time.time())
+    rows = [(k, orjson.dumps(c), now) for k, c in items if k]
+    if not rows:
+        return
+    with _card_db_lock, _card_db:
+        _card_db.executemany("INSERT OR REPLACE INTO cards (norm_name, json, fetched_at) VALUES (?, ?, ?)", rows)
+
+def _db_get_edhrec(slug: str):
+    with _card_db_lock:
+        row = _card_db.execute("SELECT json, fetched_at FROM edhrec WHERE slug=?", (slug,)).fetchone()
+    if row and time.time() - row[1] < EDHREC_CACHE_TTL:
+        return orjson.loads(row[0])
+    return None
+
+def _db_put_edhrec(slug: str, names: list):
+    with _card_db_lock, _card_db:
+        _card_db.execute("INSERT OR REPLACE INTO edhrec (slug, json, fetched_at) VALUES (?, ?, ?)",
+                         (slug, orjson.dumps(names), int(time.time())))
+
 # ----------------------------
 # API calls with caching
 # ----------------------------
-@st.cache_data(show_spinner=False)
+@st.cache_data(show_spinner=False, ttl=CARD_CACHE_TTL, max_entries=20000)
 def get_card_info(name: str):
     if not name:
         return None
+    key = _norm_name(name)
+    bulk = _bulk_index()
+    if bulk and key in bulk:
+        return dict(bulk[key])  # copy: callers annotate cards (_fn, _cid_mask)
+    cached = _db_get_card(key)
+    if cached:
+        return cached
     url = f"https://api.scryfall.com/cards/named?fuzzy={requests.utils.quote(name)}"
     try:
-        r = requests.get(url, timeout=10, headers={"User-Agent": "MTG-Deckbuilder/1.0"})
+        _SCRYFALL_RL.acquire()  # pace only real requests; cache hits return above
+        r = _SESSION.get(url, timeout=10)
         if r.status_code == 200:
-            return r.json()
+            card = orjson.loads(r.content)
+            _db_put_cards([(key, card)])
+            return card
     except Exception:
         return None
     return None
 
-@st.cache_data(show_spinner=False)
-def get_edhrec_names_html(commander_name: str):
+def _get_card_info_fuzzy(name: str):
+    """Fuzzy lookup as-is, then with the normalized name if that is actually a different query."""
+    info = get_card_info(name)
+    if info:
+        return info
+    key = _norm_name(name)
+    # Scryfall's fuzzy match ignores case, so a key that only differs in case would 404 again
+    if key and key != name.strip().lower():
+        return get_card_info(key)
+    return None
+
+SCRYFALL_BATCH = 75  # max identifiers per POST /cards/collection
+BULK_DIR = Path(".scryfall_bulk")
+BULK_TTL = 24 * 3600  # seconds
+FUZZY_CUTOFF = 0.90   # Jaro-Winkler similarity for local typo correction
+
+def _card_keys(card: dict):
+    """Normalized keys a card can be matched by: full name plus each face of a DFC/split card."""
+    name = card.get("name") or ""
+    keys = [_norm_name(name)]
+    if " // " in name:
+        keys += [_norm_name(part) for part in name.split(" // ")]
+    return keys
+
+def _is_fresh(path: Path) -> bool:
+    """True if the cached download at `path` exists and is younger than BULK_TTL."""
+    try:
+        return time.time() - path.stat().st_mtime < BULK_TTL
+    except OSError:
+        return False
+
+def _atomic_write(path: Path, chunks):
+    """Write byte chunks to a per-process tmp file, then os.replace it over `path`.
+
+    The tmp file is removed if anything fails, so an aborted download leaves nothing behind.
+    """
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+# The download loaders below raise on failure instead of returning an empty result, so
+# cache_resource never pins one; callers go through _with_backoff.
+@st.cache_resource(show_spinner=False, ttl=BULK_TTL)
+def get_card_name_index():
+    """All card names from Scryfall's catalog (disk-cached for a day) as (normalized, canonical) lists."""
+    path = BULK_DIR / "card-names.json"
+    if _is_fresh(path):
+        names = orjson.loads(path.read_bytes())
+    else:
+        _SCRYFALL_RL.acquire()
+        r = _SESSION.get("https://api.scryfall.com/catalog/card-names", timeout=30)
+        r.raise_for_status()
+        names = orjson.loads(r.content).get("data") or []
+        _atomic_write(path, [orjson.dumps(names)])
+    return _norm_name_series(pd.Series(names, dtype=object)).tolist(), names
+
+BULK_TYPE = "oracle_cards"  # one entry per card; default_cards repeats every printing
+BULK_RETRY_AFTER = 600      # seconds to wait after a failed bulk/catalog download
+# only the fields this app reads; keeps the in-memory index small
+_BULK_FIELDS = ("id", "oracle_id", "name", "cmc", "type_line", "oracle_text", "color_identity", "prices", "edhrec_rank")
+_BULK_SKIP_LAYOUTS = {"art_series", "token", "double_faced_token", "emblem", "vanguard", "scheme", "planar"}
+
+@st.cache_resource(show_spinner="Lade Scryfall-Bulk-Daten (einmal täglich) …", ttl=BULK_TTL)
+def load_bulk():
+    """Scryfall's oracle-cards dump (disk-cached for a day) as norm_name -> slim card dict.
+
+    The dicts are shared by every session; lookups hand out copies, never the entries.
+    """
+    path = BULK_DIR / "oracle-cards.json"
+    if not _is_fresh(path):
+        _SCRYFALL_RL.acquire()
+        r = _SESSION.get("https://api.scryfall.com/bulk-data", timeout=30)
+        r.raise_for_status()
+        entry = next((e for e in orjson.loads(r.content).get("data") or [] if e.get("type") == BULK_TYPE), None)
+        if not entry:
+            raise RuntimeError(f"Scryfall bulk-data has no {BULK_TYPE} entry")
+        with _SESSION.get(entry["download_uri"], timeout=120, stream=True) as dl:
+            dl.raise_for_status()
+            _atomic_write(path, dl.iter_content(chunk_size=1 << 20))
+
+    cards = [
+        {k: c[k] for k in _BULK_FIELDS if k in c}
+        for c in orjson.loads(path.read_bytes())
+        if c.get("layout") not in _BULK_SKIP_LAYOUTS
+    ]
+    # full names first (first occurrence wins), then faces, so a face name never shadows
+    # a real card of that name; vectorized, so ~35k one-off names stay out of _norm_name's LRU
+    names = [c.get("name") or "" for c in cards]
+    index = {}
+    for key, c in zip(_norm_name_series(pd.Series(names, dtype=object)), cards):
+        index.setdefault(key, c)
+    faces = [(part, c) for name, c in zip(names, cards) if " // " in name for part in name.split(" // ")]
+    for key, (_, c) in zip(_norm_name_series(pd.Series([p for p, _ in faces], dtype=object)), faces):
+        index.setdefault(key, c)
+    return index
+
+@st.cache_resource(show_spinner=False)
+def _download_failures():
+    """Download name -> time of its last failure (shared across sessions)."""
+    return {}
+
+def _with_backoff(name: str, loader):
+    """loader(), or None within BULK_RETRY_AFTER of a failed attempt (no retry storm: cache_resource
+    does not cache exceptions, so every caller would otherwise re-download)."""
+    failures = _download_failures()
+    if time.time() - failures.get(name, 0.0) < BULK_RETRY_AFTER:
+        return None
+    try:
+        return loader()
+    except Exception:
+        failures[name] = time.time()
+        return None
+
+def _bulk_index():
+    """Local bulk index, or None while it is unavailable."""
+    return _with_backoff("bulk", load_bulk)
+
+@st.cache_resource(show_spinner=False, ttl=BULK_TTL)
+def _bulk_name_index():
+    """load_bulk()'s keys as (normalized, canonical) lists, the same shape as get_card_name_index."""
+    index = load_bulk()
+    return list(index), [c.get("name") for c in index.values()]
+
+def _typo_index():
+    """Name index for typo correction: from the bulk index when it is loaded (no second
+    download), else the card-name catalog; None while neither is available."""
+    if _bulk_index() is not None:
+        return _bulk_name_index()
+    return _with_backoff("catalog", get_card_name_index)
+
+def _match_card_name(key: str, idx):
+    """Closest canonical card name for a normalized query, or None (no network)."""
+    if not idx or not key:
+        return None
+    norms, names = idx
+    hit = process.extractOne(key, norms, scorer=JaroWinkler.normalized_similarity, score_cutoff=FUZZY_CUTOFF)
+    return names[hit[2]] if hit else None
+
+def _post_collection_chunk(chunk: list):
+    """One POST /cards/collection call; returns (cards, not_found names), or None on failure."""
+    try:
+        _SCRYFALL_RL.acquire()
+        r = _SESSION.post(
+            "https://api.scryfall.com/cards/collection",
+            json={"identifiers": [{"name": n} for n in chunk]},
+            timeout=20,
+        )
+        if r.status_code != 200:
+            return None
+        data = orjson.loads(r.content)
+    except Exception:
+        return None
+    return data.get("data") or [], [nf.get("name") for nf in data.get("not_found") or [] if nf.get("name")]
+
+def _post_collection(names: list):
+    """Resolve exact names in batches of 75 (batches run concurrently, rate-limited);
+    returns (norm_name -> card, names Scryfall did not find)."""
+    found = {}
+    missing = []
+    chunks = [names[i:i + SCRYFALL_BATCH] for i in range(0, len(names), SCRYFALL_BATCH)]
+    if not chunks:
+        return found, missing
+    with ThreadPoolExecutor(max_workers=min(SCRYFALL_WORKERS, len(chunks))) as ex:
+        results = list(ex.map(_post_collection_chunk, chunks))
+    for chunk, res in zip(chunks, results):
+        if res is None:
+            missing.extend(chunk)
+            continue
+        cards, not_found = res
+        fetched = [(key, card) for card in cards for key in _card_keys(card)]
+        for key, card in fetched:
+            found.setdefault(key, card)
+        _db_put_cards(fetched)
+        missing.extend(not_found)
+    return found, missing
+
+@st.cache_data(show_spinner=False, ttl=CARD_CACHE_TTL, max_entries=32)
+def get_cards_bulk(names: tuple):
+    """Resolve many card names at once via Scryfall's collection endpoint.
+
+    Returns norm_name -> card. Names Scryfall reports as not_found are first
+    matched locally against the bulk index names (or the card-name catalog while
+    it is not loaded) and resolved from bulk or re-batched; whatever is still
+    unresolved is retried one by one through the fuzzy get_card_info.
+    """
+    out = {}
+    to_fetch = []
+    keys = _norm_name_series(pd.Series(names, dtype=object))
+    bulk = _bulk_index() or {}
+    for n, key in zip(names, keys):
+        if not key or key in out:
+            continue
+        if key in bulk:
+            out[key] = dict(bulk[key])  # copy: the index is shared process-wide
+            continue
+        cached = _db_get_card(key)
+        if cached:
+            out[key] = cached
+        else:
+            to_fetch.append(n)
+    found, missing = _post_collection(to_fetch)
+    for key, card in found.items():
+        out.setdefault(key, card)
+
+    retry = {}
+    for raw in missing:
+        key = _norm_name(raw)
+        if key not in out:
+            retry.setdefault(key, raw)
+
+    # typos: correct against the local name catalog, then one more batch round
+    corrected = {}
+    idx = _typo_index() if retry else None
+    for key in retry:
+        match = _match_card_name(key, idx)
+        if match:
+            corrected[key] = match
+    if corrected:
+        # matches from the bulk-backed index resolve locally; only catalog matches need a batch
+        found, _ = _post_collection([m for m in dict.fromkeys(corrected.values()) if _norm_name(m) not in bulk])
+        hits = []
+        for key, match in corrected.items():
+            mkey = _norm_name(match)
+            if mkey in bulk:
+                out[key] = dict(bulk[mkey])
+                del retry[key]
+                continue
+            card = found.get(mkey)
+            if card:
+                out[key] = card
+                hits.append((key, card))
+                del retry[key]
+        _db_put_cards(hits)
+
+    with ThreadPoolExecutor(max_workers=SCRYFALL_WORKERS) as ex:
+        for key, info in zip(retry, ex.map(_get_card_info_fuzzy, retry.values())):
+            if info:
+                out[key] = info
+    return out
+
+EDHREC_MIN_STRUCTURED = 50  # below this many selector hits, fall back to the text scan
+_RE_DECK_PCT = re.compile(r"^([A-Za-z0-9'\u2018\u2019\-\.\s:]+?)\s+\d+% of \d+ decks")
+
+_EDHREC_HEADERS = {"User-Agent": "Mozilla/5.0"}
+_EDHREC_CARD_SELECTORS = ", ".join([
+    "a.card__name", "a.card", ".card-name", "a[href*='/card/']", ".card-list a", ".card-list li a",
+])
+
+def _edhrec_names_json(slug: str):
+    """Card names from EDHREC's JSON page data.
+
+    [] if EDHREC has no page for the slug (404: the HTML page would not exist either);
+    None if the endpoint failed or returned nothing usable, so the caller may scrape HTML.
+    """
+    try:
+        r = _SESSION.get(f"https://json.edhrec.com/pages/commanders/{slug}.json", timeout=12, headers=_EDHREC_HEADERS)
+    except requests.RequestException:
+        return None
+    if r.status_code == 404:
+        return []
+    if r.status_code != 200:
+        return None
+    try:
+        data = orjson.loads(r.content)
+    except ValueError:
+        return None
+    cardlists = ((data.get("container") or {}).get("json_dict") or {}).get("cardlists") or []
+    names = [cv["name"] for cl in cardlists for cv in (cl.get("cardviews") or []) if cv.get("name")]
+    return names or None
+
+def _edhrec_names_html(slug: str):
     """Scrape EDHREC commander page for many possible card name selectors."""
+    # imported lazily: only needed when the JSON endpoint failed
+    from selectolax.lexbor import LexborHTMLParser
+
+    r = _SESSION.get(f"https://edhrec.com/commanders/{slug}", timeout=12, headers={**_EDHREC_HEADERS, "Accept": "text/html"})
+    if r.status_code != 200:
+        return []
+    tree = LexborHTMLParser(r.content)  # bytes: skip requests' charset sniff + str decode
+
+    candidates = []
+    # collect from several selectors known on EDHREC pages, as one selector-group query;
+    # results are in document order, and a node matching several selectors repeats
+    # (removed by the normalized dedupe in get_edhrec_card_names)
+    for node in tree.css(_EDHREC_CARD_SELECTORS):
+        txt = node.text(strip=True)
+        if txt:
+            candidates.append(txt)
+
+    # try images alt
+    for img in tree.css("img[alt]"):
+        alt = (img.attributes.get("alt") or "").strip()
+        if alt and len(alt) < 80:
+            candidates.append(alt)
+
+    # data attributes
+    for node in tree.css("[data-card-name]"):
+        name = node.attributes.get("data-card-name")
+        if name:
+            candidates.append(name)
+
+    # also scan textual blocks for lines that look like "CardName X% of N decks";
+    # only needed when the structured passes above came back thin
+    body = tree.body
+    if len(candidates) < EDHREC_MIN_STRUCTURED and body is not None:
+        for line in body.text(separator="\n", strip=True).splitlines():
+            m = _RE_DECK_PCT.match(line)
+            if m:
+                candidates.append(m.group(1).strip())
+    return candidates
+
+@st.cache_resource(show_spinner=False, ttl=EDHREC_CACHE_TTL, max_entries=256)
+def get_edhrec_card_names(commander_name: str):
+    """Card names EDHREC lists for a commander: JSON endpoint first, HTML scrape only if that failed.
+
+    Shared (cache_resource): callers only read the list, so no per-rerun unpickled copy.
+    """
     if not commander_name:
         return []
     slug = _ascii_slug(commander_name)
-    url = f"https://edhrec.com/commanders/{slug}"
+    cached = _db_get_edhrec(slug)
+    if cached is not None:
+        return cached
     try:
-        r = requests.get(url, timeout=12, headers={"User-Agent":"Mozilla/5.0"})
-        if r.status_code != 200:
-            return []
-        soup = BeautifulSoup(r.text, "lxml")
-
-        candidates = []
-        # collect from several selectors known on EDHREC pages
-        selectors = ["a.card__name", "a.card", ".card-name", "a[href*='/card/']", ".card-list a", ".card-list li a"]
-        for sel in selectors:
-            for el in soup.select(sel):
-                txt = el.get_text(strip=True)
-                if txt:
-                    candidates.append(txt)
-
-        # try images alt
-        for img in soup.find_all("img", alt=True):
-            alt = img.get("alt", "").strip()
-            if alt and len(alt) < 80:
-                candidates.append(alt)
-
-        # data attributes
-        for el in soup.find_all(attrs={"data-card-name": True}):
-            candidates.append(el["data-card-name"])
-
-        # also scan textual blocks for lines that look like "CardName X% of N decks"
-        texts = soup.get_text(separator="\n").splitlines()
-        for line in texts:
-            line = line.strip()
-            if len(line) > 4 and re.search(r"\d+% of \d+ decks", line):
-                # extract potential card name at start
-                m = re.match(r"^([A-Za-z0-9'‘’\-\.\s:]+?)\s+\d+% of \d+ decks", line)
-                if m:
-                    candidates.append(m.group(1).strip())
-
-        # normalize & dedupe preserving order
-        seen = set(); out = []
-        for t in candidates:
-            n = t.strip()
-            key = _norm_name(n)
-            if key and key not in seen:
-                seen.add(key)
-                out.append(n)
-        return out
+        candidates = _edhrec_names_json(slug)
+        if candidates is None:
+            candidates = _edhrec_names_html(slug)
     except Exception:
         return []
 
+    # normalize & dedupe preserving order (first spelling of each normalized name wins)
+    firsts = {}
+    for t in candidates:
+        n = t.strip()
+        firsts.setdefault(_norm_name(n), n)
+    firsts.pop("", None)
+    out = list(firsts.values())
+    if out:
+        _db_put_edhrec(slug, out)
+    return out
+
+# ----------------------------
+# Deck assembly
+# ----------------------------
+LAND_TARGET = 37  # lands in a 100-card deck, counting owned EDHREC/staple lands
+
+# Keyed on (commander, collection names, target curve) only: the underscore args are
+# derived from those through the cached lookups, so Streamlit skips hashing them.
+# ttl: never outlive the EDHREC list the deck was built from.
+@st.cache_data(show_spinner=False, ttl=EDHREC_CACHE_TTL, max_entries=32)
+def assemble_deck(commander_name: str, names: tuple, avg_cmc: float, _commander: dict, _scry_idx: dict, _edhrec_norm: list):
+    """Commander, owned staples, owned EDHREC hits, then land and spell fillers up to 100 cards.
+
+    Returns (deck, number of owned EDHREC hits).
+    """
+    commander, scry_idx, edhrec_norm = _commander, _scry_idx, _edhrec_norm
+    cmdr_mask = _cid_mask(commander)
+
+    # Owned EDHREC hits (legal)
+    owned_edhrec = []
+    owned_ids = set()
+    for en, key in edhrec_norm:
+        c = scry_idx.get(key)
+        if c and is_commander_legal(c, cmdr_mask):
+            owned_edhrec.append(c)
+            owned_ids.add(_card_id(c))
+
+    # add staples if owned & legal
+    staple_hits = []
+    staple_ids = set()
+    for s in STAPLES:
+        key = _norm_name(s)
+        c = scry_idx.get(key)
+        if c and is_commander_legal(c, cmdr_mask) and _card_id(c) not in staple_ids:
+            staple_hits.append(c)
+            staple_ids.add(_card_id(c))
+
+    # fillers from collection (legal, not already included). Lands (cmc 0) stay out of the
+    # curve term: they fill their own quota by EDHREC popularity, spells are sorted once by
+    # distance from the target mana value with popularity breaking ties
+    excluded_ids = owned_ids | staple_ids
+    fillers = [c for c in scry_idx.values() if _card_id(c) not in excluded_ids and is_commander_legal(c, cmdr_mask)]
+    land_fillers = sorted((c for c in fillers if _is_land(c)), key=lambda x: x.get("edhrec_rank") or 999999)
+    spell_fillers = sorted((c for c in fillers if not _is_land(c)),
+                           key=lambda x: (abs((x.get("cmc") or 0) - avg_cmc), x.get("edhrec_rank") or 999999))
+
+    # Combine deck: commander, staples, owned edhrec, lands up to the quota, spells until 100
+    deck = []
+    deck_ids = set()
+    def add(cards, limit):
+        for c in cards:
+            if len(deck) >= limit: break
+            cid = _card_id(c)
+            if cid not in deck_ids:
+                deck.append(c)
+                deck_ids.add(cid)
+    add([commander] + staple_hits + owned_edhrec, 100)
+    add(land_fillers, min(100, len(deck) + max(0, LAND_TARGET - sum(map(_is_land, deck)))))
+    add(spell_fillers, 100)
+    add(land_fillers, 100)  # not enough spells: pad with the remaining lands
+    return deck, len(owned_edhrec)
+
 # ----------------------------
 # Build action
 # ----------------------------
@@ -181,97 +705,69 @@ if st.button("🚀 Deck bauen"):
     # read collection
     try:
         if uploaded.name.lower().endswith(".csv"):
-            df = pd.read_csv(uploaded, dtype=str, keep_default_na=False)
-            first_col = df.columns[0]
-            raw_names = df[first_col].dropna().astype(str).tolist()
+            # only the first column holds names; don't parse the rest of wide exports
+            # na_filter=False: no NA detection pass, empty cells stay "" (dropped by the dedupe below)
+            df = pd.read_csv(uploaded, dtype=str, na_filter=False, usecols=[0], engine="c")
+            raw_names = df.iloc[:, 0].tolist()
         else:
-            text = uploaded.read().decode("utf-8", errors="ignore")
-            raw_names = [ln.strip() for ln in text.splitlines() if ln.strip()]
+            # decode the whole upload once instead of line by line
+            lines = (ln.strip() for ln in uploaded.getvalue().decode("utf-8", errors="ignore").splitlines())
+            raw_names = [ln for ln in lines if ln]
     except Exception as e:
         st.error(f"Collection konnte nicht gelesen werden: {e}")
         st.stop()
 
     if DEBUG: st.write(f"🔎 Geladene Einträge: {len(raw_names)} (erste 12): {raw_names[:12]}")
 
-    # get scryfall info for collection entries (cached + gentle pacing)
-    pool = []
+    # dedupe before any lookup: exact repeats (100x "Plains") first, so each distinct
+    # string is normalized once, then by normalized name ("4 Sol Ring", "SOL RING", ...)
+    raw_counts = Counter(raw_names)
+    distinct_raw = list(raw_counts)
+    counts = Counter()
+    unique = {}
+    for raw, key in zip(distinct_raw, _norm_name_series(pd.Series(distinct_raw, dtype=object))):
+        if key:
+            unique.setdefault(key, raw)
+            counts[key] += raw_counts[raw]
+
+    # get scryfall info for collection entries (batched, cached)
+    with st.spinner("Lade Karten-Infos von Scryfall …"):
+        names = tuple(sorted(unique.values()))  # sorted: cache keys ignore row order
+        found = get_cards_bulk(names)
+    # Build normalized index of collection in the same pass: norm_name -> card obj
+    scry_idx = {}
+    pool_len = 0
     not_found = []
-    progress = st.progress(0)
-    for i, raw in enumerate(raw_names):
-        if not raw: continue
-        # try as-is then normalized
-        info = get_card_info(raw)
-        if not info:
-            info = get_card_info(_norm_name(raw))
+    for key, raw in unique.items():
+        info = found.get(key)
         if info:
-            pool.append(info)
+            scry_idx[_norm_name(info.get("name", ""))] = info
+            pool_len += counts[key]
         else:
             not_found.append(raw)
-        progress.progress((i+1)/max(1, len(raw_names)))
-        time.sleep(0.03)
     if DEBUG:
-        st.write(f"✅ Scryfall-Infos gefunden: {len(pool)}; nicht gefunden: {len(not_found)} (erste 8): {not_found[:8]}")
+        st.write(f"✅ Scryfall-Infos gefunden: {pool_len} ({len(scry_idx)} verschiedene); nicht gefunden: {len(not_found)} (erste 8): {not_found[:8]}")
 
-    # EDHREC names (scrape)
-    edhrec_names = get_edhrec_names_html(commander.get("name"))
+    # EDHREC names (JSON, HTML scrape as fallback)
+    edhrec_names = get_edhrec_card_names(commander.get("name"))
     if DEBUG:
         st.write(f"🧾 EDHREC lieferte {len(edhrec_names)} Namen (erste 20): {edhrec_names[:20]}")
 
-    # Build normalized index of collection: norm_name -> card obj
-    scry_idx = {_norm_name(c.get("name","")): c for c in pool}
+    edhrec_norm = [(en, _norm_name(en)) for en in edhrec_names]
 
-    commander_identity = set(commander.get("color_identity") or [])
-
-    # Owned EDHREC hits (legal)
-    owned_edhrec = []
-    for en in edhrec_names:
-        key = _norm_name(en)
-        c = scry_idx.get(key)
-        if c and set(c.get("color_identity") or []).issubset(commander_identity):
-            owned_edhrec.append(c)
+    cmdr_mask = _cid_mask(commander)
+    deck, owned_count = assemble_deck(commander.get("name"), names, avg_cmc, commander, scry_idx, edhrec_norm)
 
-    # add staples if owned & legal
-    staple_hits = []
-    for s in STAPLES:
-        key = _norm_name(s)
-        c = scry_idx.get(key)
-        if c and set(c.get("color_identity") or []).issubset(commander_identity) and c not in staple_hits:
-            staple_hits.append(c)
+    st.success(f"✅ Deck gebaut: {len(deck)} Karten (EDHREC-Treffer in Collection: {owned_count}).")
 
-    # fillers from collection (legal, not already included)
-    fillers = [c for k,c in scry_idx.items() if c not in owned_edhrec and c not in staple_hits and set(c.get("color_identity") or []).issubset(commander_identity)]
-    fillers.sort(key=lambda x: (x.get("edhrec_rank") or 999999, x.get("cmc") or 99))
-
-    # apply avg_cmc bias by rotating
-    bias = max(0.0, min((avg_cmc - 1)/6.0, 1.0))
-    if fillers:
-        shift = int(len(fillers) * bias * 0.45)
-        fillers = fillers[shift:] + fillers[:shift]
-
-    # Combine deck: commander, staples, owned edhrec, fillers until 100
-    deck = [commander] + staple_hits
-    for c in owned_edhrec:
-        if c not in deck:
-            deck.append(c)
-    for c in fillers:
-        if len(deck) >= 100: break
-        if c not in deck:
-            deck.append(c)
-    deck = deck[:100]
-
-    st.success(f"✅ Deck gebaut: {len(deck)} Karten (EDHREC-Treffer in Collection: {len(owned_edhrec)}).")
-
-    # Build display dataframe
-    rows = []
-    for c in deck:
-        rows.append({
-            "Name": c.get("name"),
-            "Mana Value": c.get("cmc"),
-            "Type": c.get("type_line"),
-            "Function": detect_function(c),
-            "Color Identity": "".join(c.get("color_identity") or [])
-        })
-    df_deck = pd.DataFrame(rows)
+    # Build display dataframe (detect_function is cached per card in _fn)
+    df_deck = pd.DataFrame({
+        "Name": [c.get("name") for c in deck],
+        "Mana Value": pd.Series([c.get("cmc") for c in deck], dtype="float32"),
+        "Type": pd.Categorical([c.get("type_line") for c in deck]),
+        "Function": pd.Categorical([detect_function(c) for c in deck]),
+        "Color Identity": ["".join(c.get("color_identity") or []) for c in deck],
+    })
 
     if sort_after == "Kartentyp":
         df_deck = df_deck.sort_values(["Type","Mana Value","Name"], kind="stable")
@@ -281,27 +777,38 @@ if st.button("🚀 Deck bauen"):
     st.dataframe(df_deck, use_container_width=True)
 
     # Suggestions: EDHREC names not in collection -> price-filtered & legality
-    missing_names = [n for n in edhrec_names if _norm_name(n) not in scry_idx]
+    missing = [(en, key) for en, key in edhrec_norm if key not in scry_idx]
     if DEBUG:
-        st.write(f"🔍 EDHREC-Karten, die du nicht besitzt: {len(missing_names)} (erste 20): {missing_names[:20]}")
-
-    suggested = []
-    for nm in missing_names[:150]:
-        info = get_card_info(nm)
-        if not info: continue
-        if not set(info.get("color_identity") or []).issubset(commander_identity): continue
-        price = get_price_eur(info)
-        if max_price <= 0 or price <= max_price:
-            suggested.append({
-                "Name": info.get("name"),
-                "Price (EUR/USD)": price,
-                "Type": info.get("type_line"),
-                "Mana Value": info.get("cmc"),
-                "Function": detect_function(info)
-            })
-        time.sleep(0.03)
+        st.write(f"🔍 EDHREC-Karten, die du nicht besitzt: {len(missing)} (erste 20): {[en for en, _ in missing[:20]]}")
+
+    candidates = missing[:150]
+    # straight from the local bulk index when loaded (copied, like every bulk hand-out);
+    # only names it lacks go through the batch endpoint
+    bulk = _bulk_index() or {}
+    sugg_found = {key: dict(bulk[key]) for _, key in candidates if key in bulk}
+    rest = tuple(sorted(en for en, key in candidates if key not in sugg_found))
+    if rest:
+        with st.spinner("Lade Vorschläge von Scryfall …"):
+            sugg_found.update(get_cards_bulk(rest))
+    suggested = [info for info in (sugg_found.get(key) for _, key in candidates) if info]
+    df_sugg = None
     if suggested:
-        df_sugg = pd.DataFrame(suggested).sort_values(["Price (EUR/USD)","Mana Value","Name"], kind="stable")
+        # legality + price filter as column ops; only the kept cards get a Function label.
+        # price: EUR, else USD (also when the EUR string does not parse), else 0.0
+        prices = pd.DataFrame.from_records([c.get("prices") or {} for c in suggested], columns=["eur", "usd"])
+        price = (pd.to_numeric(prices["eur"], errors="coerce")
+                 .fillna(pd.to_numeric(prices["usd"], errors="coerce")).fillna(0.0))
+        legal = (pd.Series([_cid_mask(c) for c in suggested]) & ~cmdr_mask) == 0
+        keep = legal & ((max_price <= 0) | (price <= max_price))
+        df_sugg = pd.DataFrame({
+            "Name": [c.get("name") for c in suggested],
+            "Price (EUR/USD)": price,
+            "Type": [c.get("type_line") for c in suggested],
+            "Mana Value": pd.Series([c.get("cmc") for c in suggested], dtype="float32"),
+        }).loc[keep]
+        df_sugg = df_sugg.assign(Function=[detect_function(suggested[i]) for i in df_sugg.index])
+        df_sugg = df_sugg.sort_values(["Price (EUR/USD)","Mana Value","Name"], kind="stable")
+    if df_sugg is not None and not df_sugg.empty:
         st.subheader("💡 Vorschläge (EDHREC-Karten, die du nicht besitzt, Preisfilter angewendet)")
         st.dataframe(df_sugg, use_container_width=True)
     else: